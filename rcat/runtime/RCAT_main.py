@@ -5,20 +5,28 @@
 
 import sys
 import os
-import glob
+import argparse
+import operator
 import xarray as xa
 import xesmf as xe
+import dask
+import dask.array as da
 import pandas as pd
 from pandas import to_timedelta
 import datetime as dt
 from itertools import product
+from bisect import bisect_left
+from functools import lru_cache, reduce
+from inspect import signature
+from importlib.machinery import SourceFileLoader
 import numpy as np
 import re
-from dask.distributed import Client
+from dask.distributed import Client, LocalCluster, get_client
 from rcat.utils import ini_reader
-from rcat.utils.polygons import mask_region
+from rcat.utils.polygons import mask_regions
 import rcat.runtime.RCAT_stats as st
 import rcat.utils.grids as gr
+import rcat.runtime.RCAT_plots as rplot
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -53,15 +61,61 @@ def get_settings(config_file):
         'outdir': conf_dict['SETTINGS']['output dir'],
     }
 
+    # Fail fast on misconfigured resample methods and precision
+    _check_resample_methods(d['stats_conf'])
+    _check_precision(d['variables'])
+
     return d
 
 
+# Resample methods allowed in 'resample resolution' settings
+_RESAMPLE_METHODS = ('mean', 'sum', 'max', 'min', 'median', 'std', 'var',
+                     'prod', 'count')
+
+
+def _check_precision(variables):
+    """
+    Check that precision settings of variables are valid.
+    """
+    for var, vconf in variables.items():
+        precision = vconf.get('precision', 'float32')
+        if precision not in ('float32', 'float64'):
+            raise ValueError(
+                f"\n\n\tPrecision '{precision}' for variable '{var}' is not "
+                f"valid! Valid options are: float32, float64")
+
+
+def _check_resample_methods(stats_conf):
+    """
+    Check that resample methods in statistics configuration are valid.
+    """
+    def _check(tresample, stat):
+        errmsg = (f"\n\n\tResample method '{tresample[1]}' for statistic "
+                  f"'{stat}' is not valid! Valid methods are: "
+                  f"{', '.join(_RESAMPLE_METHODS)}")
+        if tresample[0] not in ('select hours', 'select dates'):
+            if tresample[1] not in _RESAMPLE_METHODS:
+                raise ValueError(errmsg)
+
+    for stat, sconf in stats_conf.items():
+        resample_args = sconf.get('resample resolution')
+        if resample_args is not None:
+            if isinstance(resample_args, dict):
+                [_check(tres, stat) for tres in resample_args.values()]
+            else:
+                _check(resample_args, stat)
+        cond_dict = sconf.get('cond analysis')
+        if cond_dict is not None:
+            [_check(cond['resample resolution'], stat)
+             for cond in cond_dict.values()
+             if cond.get('resample resolution') is not None]
+
+
 def local_cluster_setup():
     """
     Set up local-pc cluster
 
     """
-    from dask.distributed import LocalCluster
     cluster = LocalCluster(processes=False)
     return cluster
 
@@ -93,7 +147,6 @@ def get_args():
     -------
     Input arguments
     """
-    import argparse
 
     # Configuring argument setup and handling
     parser = argparse.ArgumentParser(
@@ -104,29 +157,29 @@ def get_args():
     return parser.parse_args()
 
 
-def get_grid_coords(ds, grid_coords):
+def get_grid_coords(grid, grid_coords):
     """
     Read model grid coordinates
 
     Parameters
     ----------
-    ds: xarray dataset
+    grid: dict
+        Dictionary with (in-memory) 'lon' and 'lat' arrays, as returned by
+        get_mod_data/get_obs_data
+    grid_coords: dict
+        Dictionary to be updated with grid meta data
     Returns
     -------
     grid_coords: dict
     """
 
     def _domain(lats, lons, x):
-        lons_p = np.r_[lons[x, x:-x], lons[x:-x, -1-x][1:],
-                       lons[-1-x, x:-x][::-1][1:], lons[x:-x, x][::-1][1:]]
-        lats_p = np.r_[lats[x, x:-x], lats[x:-x, -1-x][1:],
-                       lats[-1-x, x:-x][::-1][1:], lats[x:-x, x][::-1][1:]]
-        return list(zip(lons_p, lats_p))
+        rows, cols = _perimeter_index(lats.shape, x)
+        return np.column_stack([lons[rows, cols], lats[rows, cols]])
 
     # If lon/lat is 1D; create 2D meshgrid
-    xd, yd = _space_coords(ds)
-    lons = ds[xd].values
-    lats = ds[yd].values
+    lons = np.asarray(grid['lon'])
+    lats = np.asarray(grid['lat'])
     lon, lat = np.meshgrid(lons, lats)\
         if lats.ndim == 1 else (lons, lats)
 
@@ -146,6 +199,23 @@ def get_grid_coords(ds, grid_coords):
     return grid_coords
 
 
+@lru_cache(maxsize=None)
+def _perimeter_index(shape, x):
+    """
+    Row/column indices tracing the perimeter of a 2D grid with given shape,
+    x grid points in from the edges. The trace is closed: it starts at
+    corner (x, x) and repeats that point at the end.
+    """
+    ny, nx = shape
+    r = np.arange(x, ny-x)
+    c = np.arange(x, nx-x)
+    rows = np.concatenate([np.full(c.size, x), r[1:],
+                           np.full(c.size-1, ny-1-x), r[::-1][1:]])
+    cols = np.concatenate([c, np.full(r.size-1, nx-1-x), c[::-1][1:],
+                           np.full(r.size-1, x)])
+    return rows, cols
+
+
 def get_grids(nc, target_grid, method='bilinear'):
     """
     Get and/or modify the source and target grids for interpolation
@@ -188,11 +258,13 @@ def regrid_func(dd, v, vconf, mnames, onames, gdict):
                           'lat': {gridname: target_grid['lat'].values}})
             for mod in mnames:
                 dd[mod]['data'] = regrid_calc(dd, mod, v, target_grid,
-                                              vconf['rgr method'])
+                                              vconf['rgr method'],
+                                              vconf['precision'])
             if None not in onames:
                 for obs in onames:
                     dd[obs]['data'] = regrid_calc(dd, obs, v, target_grid,
-                                                  vconf['rgr method'])
+                                                  vconf['rgr method'],
+                                                  vconf['precision'])
         elif vconf['regrid'] in onames:
             oname = vconf['regrid']
             target_grid = dd[oname]['grid']
@@ -201,13 +273,15 @@ def regrid_func(dd, v, vconf, mnames, onames, gdict):
                           'lat': {oname: target_grid['lat']}})
             for m in mnames:
                 dd[m]['data'] = regrid_calc(dd, m, v, target_grid,
-                                            vconf['rgr method'])
+                                            vconf['rgr method'],
+                                            vconf['precision'])
             if len(onames) > 1:
                 obslist = onames.copy()
                 obslist.remove(oname)
                 for obs in obslist:
                     dd[obs]['data'] = regrid_calc(dd, obs, v, target_grid,
-                                                  vconf['rgr method'])
+                                                  vconf['rgr method'],
+                                                  vconf['precision'])
         elif vconf['regrid'] in mnames:
             mname = vconf['regrid']
             modlist = mnames.copy()
@@ -218,11 +292,13 @@ def regrid_func(dd, v, vconf, mnames, onames, gdict):
                           'lat': {mname: target_grid['lat']}})
             for mod in modlist:
                 dd[mod]['data'] = regrid_calc(dd, mod, v, target_grid,
-                                              vconf['rgr method'])
+                                              vconf['rgr method'],
+                                              vconf['precision'])
             if None not in onames:
                 for obs in onames:
                     dd[obs]['data'] = regrid_calc(dd, obs, v, target_grid,
-                                                  vconf['rgr method'])
+                                                  vconf['rgr method'],
+                                                  vconf['precision'])
         else:
             raise ValueError(("\n\n\tTarget grid name not found!\n"
                               "Check 'regrid to' option in main config file"))
@@ -232,7 +308,8 @@ def regrid_func(dd, v, vconf, mnames, onames, gdict):
     return dd, gdict
 
 
-def regrid_calc(data, data_name, var, target_grid, method):
+def regrid_calc(data, data_name, var, target_grid, method,
+                precision='float32'):
     print("\t\t** Regridding {} data **\n".format(data_name.upper()))
 
     indata = data[data_name]['data']
@@ -240,15 +317,75 @@ def regrid_calc(data, data_name, var, target_grid, method):
     # Get grid info
     sgrid, tgrid = get_grids(indata, target_grid, method)
 
-    # Regridding
+    # Regridding weights
     regridder = gr.add_matrix_NaNs(xe.Regridder(sgrid, tgrid, method))
     # regridder.clean_weight_file()
-    ds_rgr = regridder(indata[var])
-    dset = ds_rgr.to_dataset()
+
+    # Weights and data are cast to 'precision' (float32 by default) to reduce
+    # memory traffic in the (memory bound) sparse matrix product. CSR arrays
+    # are scattered once to all workers rather than serialized into every
+    # task.
+    dtype = np.dtype(precision)
+    A = regridder.weights.tocsr()
+    out_dims = tuple(regridder.shape_out)
+    [csr_bundle] = get_client().scatter(
+        [(A.indptr, A.indices, A.data.astype(dtype), A.shape)],
+        broadcast=True)
+
+    # Output dimensions/coordinates follow the dimensionality of target grid
+    tlon = np.asarray(tgrid['lon'])
+    tlat = np.asarray(tgrid['lat'])
+    if tlon.ndim == 1:
+        hdims = ('lat', 'lon')
+        coords = {'lon': ('lon', tlon), 'lat': ('lat', tlat)}
+    else:
+        hdims = ('y', 'x')
+        coords = {'lon': (hdims, tlon), 'lat': (hdims, tlat)}
+
+    # Horizontal (core) dimensions must not be chunked; source grid
+    # coordinates are dropped as they are replaced by the target grid.
+    xd, yd = _space_dim(indata)
+    data_in = indata[var].astype(dtype, copy=False).chunk({yd: -1, xd: -1})
+    data_in = data_in.drop_vars(
+        [c for c in data_in.coords if {xd, yd} & set(data_in[c].dims)])
+
+    ds_rgr = xa.apply_ufunc(
+        _rgr_blocks, data_in,
+        kwargs={'csr_bundle': csr_bundle, 'out_dims': out_dims},
+        input_core_dims=[[yd, xd]], output_core_dims=[list(hdims)],
+        exclude_dims={yd, xd}, dask='allowed')
+    dset = ds_rgr.assign_coords(coords).to_dataset(name=var)
 
     return dset
 
 
+def _rgr_blocks(arr, csr_bundle, out_dims):
+    """
+    Map the regridding over the blocks of a dask array with shape (..., y, x).
+    The scattered weights are passed as a map_blocks keyword so that dask
+    replaces the future with its data on the workers.
+    """
+    return da.map_blocks(
+        _rgr_calc, arr, dtype=arr.dtype,
+        chunks=arr.chunks[:-2] + tuple((n,) for n in out_dims),
+        csr_bundle=csr_bundle, out_dims=out_dims)
+
+
+def _rgr_calc(data, csr_bundle, out_dims):
+    """
+    Apply CSR regridding weights to a block of data with shape (..., y, x).
+    csr_bundle is the tuple (indptr, indices, data, shape) of the weights.
+    Output has the same dtype as input data (accumulation is done in float64).
+    """
+    indptr, indices, vals, shape = csr_bundle
+    lead = data.shape[:-2]
+    data_flat = np.ascontiguousarray(
+        data.reshape(-1, data.shape[-2]*data.shape[-1]))
+    out = np.empty((data_flat.shape[0], shape[0]), dtype=data_flat.dtype)
+    gr.get_spmm_kernel(*shape)(indptr, indices, vals, data_flat, out)
+    return out.reshape(lead + out_dims)
+
+
 def resampling(data, v, tresample):
     """
     Resample data to chosen time frequency and resample method.
@@ -271,16 +408,26 @@ def resampling(data, v, tresample):
         sec_resample = to_timedelta(tr, fr).total_seconds()
         if nsec != sec_resample:
             if sec_resample < 24*3600:
-                data = eval(
-                    f"data.resample(time='{tresample[0]}', "
-                    f"label='right', closed='right').{tresample[1]}('time')."
-                    f"dropna('time', 'all')")
+                rs_kw = {'label': 'right', 'closed': 'right'}
+            else:
+                rs_kw = {}
+            # Resample bins without any input time steps (e.g. in between
+            # selected months) are all NaN. Identify them from the time
+            # coordinate alone, instead of a dropna pass over all data.
+            nsteps = data.time.resample(time=tresample[0], **rs_kw).count()
+            # Accumulate in float64, but return data in input precision
+            f32 = data[v].dtype == np.float32
+            if f32:
+                data = data.assign({v: data[v].astype(np.float64)})
+            data = getattr(data.resample(time=tresample[0], **rs_kw),
+                           tresample[1])('time')
+            data = data.isel(time=nsteps.values > 0)
+            if f32 and data[v].dtype == np.float64:
+                data = data.assign({v: data[v].astype(np.float32)})
+            if sec_resample < 24*3600:
                 # EDIT Petter 210608: Should the time stamp be set to midpoint?
                 data['time'] = data.time - np.timedelta64(
                     dt.timedelta(seconds=np.round(sec_resample/2)))
-            else:
-                data = eval(f"data.resample(time='{tresample[0]}')."
-                            f"{tresample[1]}('time').dropna('time', 'all')")
         else:
             print("\t\tData is already at target resolution, skipping "
                   "resampling ...\n")
@@ -291,7 +438,6 @@ def conditional_data(dd_condition, cond_var, cond_data, indata, in_var):
     """
     Sub-select data conditional on other data
     """
-    import operator
 
     def _percentile_func(arr, axis=0, q=95, thr=None):
         if thr is not None:
@@ -423,16 +569,23 @@ def calc_stats(ddict, vlist, stat, pool, chunk_dim, stats_config, regions):
                 else:
                     data = manage_chunks(indata, chunk_dim)
 
+                # Statistics (sums/means over long periods) are accumulated
+                # in float64, also for float32 (regridded) data. Cast after
+                # rechunking so the rechunk shuffle moves float32 data.
+                if data[v].dtype == np.float32:
+                    data = data.assign({v: data[v].astype(np.float64)})
+
                 # Calculate stats
                 st_data[v][m]['domain'] = st.calc_statistics(data, v, stat,
                                                              stats_config)
                 if regions:
                     xd, yd = _space_coords(data)
-                    masks = {
-                        r: mask_region(
-                            data[xd].values, data[yd].values, r,
-                            cut_data=False) for r in regions}
+                    masks = mask_regions(data[xd].values, data[yd].values,
+                                         regions)
                     if pool:
+                        # N.B. Region data share the input graph and are
+                        # computed together with domain stats when saved
+                        # (see save_to_disk).
                         mdata = {r: get_masked_data(data, v, masks[r])
                                  for r in regions}
 
@@ -449,24 +602,30 @@ def calc_stats(ddict, vlist, stat, pool, chunk_dim, stats_config, regions):
     return st_data
 
 
+_MONTH_CHARS = ('_', 'J', 'F', 'M', 'A', 'M', 'J', 'J', 'A', 'S', 'O', 'N',
+                'D')
+_MONTH_NAMES = ('_', 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug',
+                'Sep', 'Oct', 'Nov', 'Dec')
+
+
 def get_month_string(mlist):
-    d = {1: 'J', 2: 'F', 3: 'M', 4: 'A', 5: 'M', 6: 'J', 7: 'J', 8: 'A',
-         9: 'S', 10: 'O', 11: 'N', 12: 'D'}
-    dl = {1: 'Jan', 2: 'Feb', 3: 'Mar', 4: 'Apr', 5: 'May', 6: 'Jun', 7: 'Jul',
-          8: 'Aug', 9: 'Sep', 10: 'Oct', 11: 'Nov', 12: 'Dec'}
+    return _month_string(tuple(mlist))
+
+
+@lru_cache(maxsize=None)
+def _month_string(mlist):
     if len(mlist) == 12:
         mstring = 'ANN'
     elif len(mlist) == 1:
-        mstring = dl[mlist[0]]
+        mstring = _MONTH_NAMES[mlist[0]]
     else:
-        if mlist in ([1, 2, 12], (1, 2, 12)):
+        if mlist == (1, 2, 12):
             mlist = (12, 1, 2)
-        mstring = ''.join(d[m] for m in mlist)
+        mstring = ''.join(_MONTH_CHARS[m] for m in mlist)
     return mstring
 
 
 def _get_freq(tf):
-    from functools import reduce
 
     d = [j.isdigit() for j in tf]
     if np.any(d):
@@ -519,33 +678,57 @@ def _space_coords(ds):
     return xd, yd
 
 
+def get_stats_meta(stats_conf):
+    """
+    Pre-compute file name components for each statistic in stats_conf;
+    statistic name, name used in file names, time statistic and threshold
+    strings for variables.
+    """
+    stats_meta = {}
+    for stat, sconf in stats_conf.items():
+        stat_name = stat.replace(' ', '_')
+        if stat in ('annual cycle', 'seasonal cycle', 'diurnal cycle'):
+            # _tstat = sconf['stat method'].partition(' ')[0]
+            # tstat = '_' + re.sub(r'[^a-zA-Z0-9 \.\n]', '', _tstat).\
+            #         replace(' ', '_')
+            tstat = '_' + sconf['stat method'].replace(' ', '')
+        else:
+            tstat = ''
+        if stat == 'diurnal cycle':
+            stat_fn = "{}_{}".format(stat_name, sconf['dcycle stat'])
+        else:
+            stat_fn = stat_name
+        thr = sconf['thr'] if 'thr' in sconf else None
+        thrstr = {} if thr is None else {
+            v: "thr{}_".format(str(t)) for v, t in thr.items()}
+        stats_meta[stat] = {'name': stat_name, 'fn': stat_fn, 'tstat': tstat,
+                            'thr str': thrstr}
+    return stats_meta
+
+
 def save_to_disk(data, label, stat, odir, var, grid, sy, ey, tsuffix,
-                 stat_dict, tres, thr='', regs=None):
+                 stat_meta, tres, thr='', regs=None):
     """
     Saving statistical data to netcdf files
+
+    Domain and region files are written in a single dask computation, so
+    input data shared between them (e.g. pooled regions) is only read once.
+    Data is stored as compressed float32.
     """
-    # encoding = {'lat': {'dtype': 'float32', '_FillValue': False},
-    #             'lon': {'dtype': 'float32', '_FillValue': False},
-    #             var: {'dtype': 'float32', '_FillValue': 1.e20}
-    #             }
-    if stat in ('annual cycle', 'seasonal cycle', 'diurnal cycle'):
-        # _tstat = stat_dict['stat method'].partition(' ')[0]
-        # tstat = '_' + re.sub(r'[^a-zA-Z0-9 \.\n]', '', _tstat).\
-        #         replace(' ', '_')
-        tstat = '_' + stat_dict['stat method'].replace(' ', '')
-    else:
-        tstat = ''
-    stat_name = stat.replace(' ', '_')
-    if stat in ('diurnal cycle'):
-        stat_fn = "{}_{}".format(stat_name, stat_dict['dcycle stat'])
-    else:
-        stat_fn = stat_name
+    encoding = {'lat': {'dtype': 'float32', '_FillValue': False},
+                'lon': {'dtype': 'float32', '_FillValue': False},
+                var: {'dtype': 'float32', 'zlib': True, 'complevel': 4,
+                      '_FillValue': 1.e20}
+                }
+    tstat = stat_meta['tstat']
+    stat_name = stat_meta['name']
+    stat_fn = stat_meta['fn']
 
     fname = '{}_{}_{}_{}{}{}_{}_{}-{}_{}.nc'.format(
         label, stat_fn, var, thr, tres, tstat, grid, sy, ey, tsuffix)
     data['domain'].attrs['Analysed time'] = "{}-{} | {}".format(sy, ey,
                                                                 tsuffix)
-    data['domain'].to_netcdf(os.path.join(odir, stat_name, fname))
+    outfiles = [(data['domain'], os.path.join(odir, stat_name, fname))]
 
     if regs is not None:
         for r in regs:
@@ -555,43 +738,43 @@ def save_to_disk(data, label, stat, odir, var, grid, sy, ey, tsuffix,
             fname = '{}_{}_{}_{}{}{}_{}_{}_{}-{}_{}.nc'.format(
                 label, stat_fn, var, thr, tres, tstat, rn, grid, sy, ey,
                 tsuffix)
-            data['regions'][r].to_netcdf(os.path.join(odir, stat_name, fname))
+            outfiles.append((data['regions'][r],
+                             os.path.join(odir, stat_name, fname)))
+
+    writes = [ds.to_netcdf(fpath, engine='h5netcdf', compute=False,
+                           encoding={k: e for k, e in encoding.items()
+                                     if k in ds.variables})
+              for ds, fpath in outfiles]
+    dask.compute(*writes)
 
 
 def get_masked_data(data, var, mask):
     """
     Mask region
+
+    Data is first cropped to the bounding box of the region, after which the
+    2D mask is applied (broadcast lazily over any other dimensions).
+    """
+    try:
+        xd, yd = _space_dim(data)
+    except IndexError:
+        # Unknown dimension names; assume (..., y, x) layout
+        yd, xd = data[var].dims[-2:]
+    ys, xs = _mask_bbox(mask)
+    sub_data = data.isel({yd: ys, xd: xs})
+    mask_in = xa.DataArray(mask[ys, xs], dims=(yd, xd))
+    return sub_data.where(mask_in)
+
+
+def _mask_bbox(mask):
     """
-    mask_in = xa.DataArray(np.broadcast_to(mask, data[var].shape),
-                           dims=data[var].dims)
-    return data.where(mask_in, drop=True)
-
-    # Petter Lind 2019-10-29
-    # N.B. For masking of large data sets, the code below might be a more
-    # viable choice.
-    #
-    # def _mask_func(arr, axis=0, lons=None, lats=None, region=''):
-    #     iter_3d = arr.shape[axis]
-    #     mdata = mask_region(lons, lats, region, arr, iter_3d=iter_3d,
-    #                               cut_data=True)[0]
-    #     return mdata
-
-    # mask = mask_region(data.lon.values, data.lat.values, reg,
-    #                          cut_data=True)
-
-    # imask = mask[0]
-    # mask_data = da.map_blocks(_mask_func, data[var].data, dtype=float,
-    #                           chunks=(data.chunks['time'],
-    #                                   imask.shape[0], imask.shape[1]),
-    #                           lons=data.lon.values, lats=data.lat.values,
-    #                           region=reg)
-    # lon_d = 'x' if mask[1].ndim == 1 else ['y', 'x']
-    # lat_d = 'y' if mask[2].ndim == 1 else ['y', 'x']
-    # out = xa.Dataset(
-    #     {var: (['time', 'y', 'x'],  mask_data)},
-    #     coords={'lon': (lon_d, mask[1]), 'lat': (lat_d, mask[2]),
-    #             'time': data.time.values})
-    # return out_mdata
+    Return index slices (y, x) of the bounding box of True values in mask.
+    """
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    cols = np.flatnonzero(np.any(mask, axis=0))
+    if rows.size == 0:
+        return slice(0, 0), slice(0, 0)
+    return slice(rows[0], rows[-1]+1), slice(cols[0], cols[-1]+1)
 
 
 def manage_chunks(data, chunk_dim):
@@ -631,15 +814,24 @@ def manage_chunks(data, chunk_dim):
         else:
             data = data.chunk({xd: xsize, yd: ysize})
 
-    # return data.persist()
+    # N.B. Data is deliberately not persisted here (nor after regridding);
+    # statistics trigger computation lazily, keeping cluster memory low.
     return data
 
 
+# Cache for get_variable_config; var_config is kept in the cached value so
+# that its id cannot be reused during the run
+_VAR_CONFIG_CACHE = {}
+
+
 def get_variable_config(var_config, var):
     """
     Retrieve configuration info for variable var as defined in main
     configuration file,
     """
+    key = (id(var_config), var)
+    if key in _VAR_CONFIG_CACHE:
+        return _VAR_CONFIG_CACHE[key][1]
     vdict = {
         'var names': var_config['var names'],
         'input resolution': var_config['freq'],
@@ -652,7 +844,10 @@ def get_variable_config(var_config, var):
         var_config else None,
         'rgr method': var_config['regrid method'] if 'regrid method' in
         var_config else None,
+        'precision': var_config['precision'] if 'precision' in
+        var_config else 'float32',
     }
+    _VAR_CONFIG_CACHE[key] = (var_config, vdict)
     return vdict
 
 
@@ -660,7 +855,6 @@ def variabel_modification(dd, nv_dd, funargs, mlist, olist):
     """
     Create new or modify existing variables.
     """
-    from inspect import signature
     out_dd = {}
     expression = nv_dd['expression']
     func = eval(f"lambda {funargs}: {expression}")
@@ -696,8 +890,6 @@ def get_mod_data(model, mconf, tres, var, vnames, cfactor, deacc):
     """
     Open model data files where file path is dependent on time resolution tres.
     """
-    import re
-
     print("\t-- Opening {} files\n".format(model.upper()))
 
     fyear = mconf['start year']
@@ -715,9 +907,16 @@ def get_mod_data(model, mconf, tres, var, vnames, cfactor, deacc):
             readvar = var
     else:
         readvar = var
-    file_path = os.path.join(mconf['fpath'],
-                             f'{tres}/{readvar}/{readvar}_*.nc')
-    _flist = glob.glob(file_path)
+    # List files with a single directory scan
+    file_dir = os.path.join(mconf['fpath'], tres, readvar)
+    file_path = os.path.join(file_dir, f'{readvar}_*.nc')
+    if os.path.isdir(file_dir):
+        with os.scandir(file_dir) as it:
+            _flist = [os.path.join(file_dir, e.name) for e in it
+                      if e.name.startswith(f'{readvar}_') and
+                      e.name.endswith('.nc')]
+    else:
+        _flist = []
 
     errmsg = (f"Could not find any files at specified location:\n{file_path} "
               "\n\nexiting ...")
@@ -725,12 +924,7 @@ def get_mod_data(model, mconf, tres, var, vnames, cfactor, deacc):
         print("\t\n{}".format(errmsg))
         sys.exit()
 
-    _file_dates = [re.split('-|_', f.rsplit('.')[-2])[-2:] for f in _flist]
-    file_dates = [(d[0][:6], d[1][:6]) for d in _file_dates]
-    fidx = [np.where([d[0] <= date <= d[1] for d in file_dates])[0]
-            for date in date_list]
-    flist = [_flist[i] for i in np.unique(np.hstack(fidx))]
-    flist.sort()
+    flist = _select_files(_flist, date_list)
 
     if np.unique([len(f) for f in flist]).size > 1:
         flngth = np.unique([len(f) for f in flist])
@@ -741,29 +935,23 @@ def get_mod_data(model, mconf, tres, var, vnames, cfactor, deacc):
     ch_x = mconf['chunks_x']
     ch_y = mconf['chunks_y']
 
-    if deacc:
-        _mdata = xa.open_mfdataset(
-            flist, parallel=True,  # engine='h5netcdf',
-            data_vars='minimal', coords='minimal',
-            concat_dim='time', combine='by_coords', compat='override',
-            chunks={**ch_t, **ch_x, **ch_y},
-            preprocess=(lambda arr: arr.diff('time')))
-        # if ch_t['time'] == -1:
-        #     _mdata = _mdata.chunk({'time': -1}).unify_chunks()
+    # Accumulated fields are de-accumulated per file; files of non-selected
+    # months are not opened, so a diff after concatenation would span gaps.
+    _mdata = xa.open_mfdataset(
+        flist, parallel=True,  # engine='h5netcdf',
+        data_vars='minimal', coords='minimal',
+        concat_dim='time', combine='by_coords', compat='override',
+        chunks={**ch_t, **ch_x, **ch_y},
+        preprocess=(lambda arr: arr.diff('time')) if deacc else None)
+    # if ch_t['time'] == -1:
+    #     _mdata = _mdata.chunk({'time': -1}).unify_chunks()
 
+    if deacc:
         # Modify time stamps to mid-point
         diff = _mdata.time.values[1] - _mdata.time.values[0]
         nsec = to_timedelta(diff).total_seconds()
         _mdata['time'] = _mdata.time -\
             np.timedelta64(dt.timedelta(seconds=np.round(nsec/2)))
-    else:
-        _mdata = xa.open_mfdataset(
-            flist, parallel=True,  # engine='h5netcdf',
-            data_vars='minimal', coords='minimal',
-            concat_dim='time', combine='by_coords', compat='override',
-            chunks={**ch_t, **ch_x, **ch_y})
-        # if ch_t['time'] == -1:
-        #     _mdata = _mdata.chunk({'time': -1}).unify_chunks()
 
     # -- Dimensions ---
 
@@ -822,6 +1010,9 @@ def get_mod_data(model, mconf, tres, var, vnames, cfactor, deacc):
             swap_dims({'rlon': 'x', 'rlat': 'y'})
         grid = {'lon': lon_reg, 'lat': lat_reg}
     else:
+        # Load lon/lat once; subsequent steps reuse the in-memory arrays
+        mdata = mdata.assign_coords({xd: mdata[xd].load(),
+                                     yd: mdata[yd].load()})
         grid = {'lon': mdata[xd].values, 'lat': mdata[yd].values}
 
     outdata = {'data': mdata.unify_chunks(),
@@ -830,12 +1021,38 @@ def get_mod_data(model, mconf, tres, var, vnames, cfactor, deacc):
     return outdata
 
 
+def _select_files(flist, date_list):
+    """
+    Select files that cover any of the dates (strings 'YYYYMM') in date_list.
+    File names must end with the date range of the file, e.g.
+    '<prefix>_YYYYMM[DD..]-YYYYMM[DD..].nc'. Returns a sorted list.
+    """
+    dates = sorted(date_list)
+    sel = []
+    for f in flist:
+        d = re.split('-|_', f.rsplit('.')[-2])[-2:]
+        d0, d1 = d[0][:6], d[1][:6]
+        # First requested date not before file start date
+        i = bisect_left(dates, d0)
+        if i < len(dates) and dates[i] <= d1:
+            sel.append(f)
+    sel.sort()
+    return sel
+
+
+@lru_cache(maxsize=None)
+def _load_obs_metadata(metadata_file):
+    """
+    Load observations metadata module (once per metadata file).
+    """
+    return SourceFileLoader("obs_meta", metadata_file).load_module()
+
+
 def get_obs_data(metadata_file, obs, var, cfactor, sy, ey, mns):
     """
     Open obs data files.
     """
-    from importlib.machinery import SourceFileLoader
-    obs_meta = SourceFileLoader("obs_meta", metadata_file).load_module()
+    obs_meta = _load_obs_metadata(metadata_file)
     # obs_dict = obs_meta.obs_data()
 
     sdate = '{}{:02d}'.format(sy, np.min(mns))
@@ -854,12 +1071,7 @@ def get_obs_data(metadata_file, obs, var, cfactor, sy, ey, mns):
 
     date_list = ["{}{:02d}".format(yy, mm) for yy, mm in product(
         range(sy, ey+1), mns)]
-    _file_dates = [re.split('-|_', f.rsplit('.')[-2])[-2:] for f in obs_flist]
-    file_dates = [(d[0][:6], d[1][:6]) for d in _file_dates]
-    fidx = [np.where([d[0] <= date <= d[1] for d in file_dates])[0]
-            for date in date_list]
-    flist = [obs_flist[i] for i in np.unique(np.hstack(fidx))]
-    flist.sort()
+    flist = _select_files(obs_flist, date_list)
     f_obs = xa.open_mfdataset(
         flist, parallel=True,   # engine='h5netcdf',
         data_vars='minimal', coords='minimal',
@@ -885,18 +1097,23 @@ def get_obs_data(metadata_file, obs, var, cfactor, sy, ey, mns):
     # Labels for spatial dimensions
     xd, yd = _space_dim(obs_data)
 
-    # Make sure lon/lat elements are in ascending order
-    if obs_data[xc].ndim == 1:
-        if np.diff(obs_data[xc])[0] < 0:
-            obs_data = obs_data.reindex({xd: np.flipud(obs_data[xd])})
-        if np.diff(obs_data[yc])[0] < 0:
-            obs_data = obs_data.reindex({yd: np.flipud(obs_data[yd])})
-    elif obs_data[xc].ndim == 2:
-        if np.diff(obs_data[xc][0, :])[0] < 0:
-            obs_data = obs_data.reindex({xd: np.flipud(obs_data[xd])})
-        if np.diff(obs_data[yc][:, 0])[0] < 0:
-            obs_data = obs_data.reindex({yd: np.flipud(obs_data[yd])})
-
+    # Make sure lon/lat elements are in ascending order. Reversing with isel
+    # is a lazy view, whereas reindex would align (and move) all data.
+    def _first_diff(c, dim):
+        c1d = c if c.ndim == 1 else c.isel({d: 0 for d in c.dims if d != dim})
+        return np.diff(c1d.values[:2])[0]
+
+    if _first_diff(obs_data[xc], xd) < 0:
+        obs_data = obs_data.isel({xd: slice(None, None, -1)})
+    if _first_diff(obs_data[yc], yd) < 0:
+        obs_data = obs_data.isel({yd: slice(None, None, -1)})
+    errmsg = "\n\n\tObs lon/lat could not be arranged in ascending order!"
+    assert _first_diff(obs_data[xc], xd) > 0 and \
+        _first_diff(obs_data[yc], yd) > 0, errmsg
+
+    # Load lon/lat once; subsequent steps reuse the in-memory arrays
+    obs_data = obs_data.assign_coords({xc: obs_data[xc].load(),
+                                       yc: obs_data[yc].load()})
     lons = obs_data[xc].values
     lats = obs_data[yc].values
 
@@ -970,49 +1187,37 @@ def timeres_def(resample, cdict, v, mod, obs):
 
 
 def get_plot_dict(cdict, var, grid_coords, models, obs, yrs_d, mon_d, tres,
-                  img_outdir, stat_outdir, stat):
+                  img_outdir, stat_outdir, stat, stat_meta):
     """
     Create a dictionary with settings for a validation plot procedure.
     """
     # Get some settings and meta data
     vconf = get_variable_config(cdict['variables'][var], var)
     grdnme = grid_coords['target grid'][var]['gridname']
-    st = stat.replace(' ', '_')
-    if stat == 'diurnal cycle':
-        stnm = "{}_{}".format(st, cdict['stats_conf'][stat]['dcycle stat'])
-    else:
-        stnm = st
-    if stat in ('annual cycle', 'seasonal cycle', 'diurnal cycle'):
-        # if 'percentile' in cdict['stats_conf'][stat]['stat method']:
-        #     tstat = '_percentile'
-        tstat = '_' + cdict['stats_conf'][stat]['stat method'].replace(
-            ' ', '')
-    else:
-        tstat = ''
-    thrlg = (('thr' in cdict['stats_conf'][stat]) and
-             (cdict['stats_conf'][stat]['thr'] is not None) and
-             (var in cdict['stats_conf'][stat]['thr']))
-    if thrlg:
-        thrstr = "thr{}_".format(str(cdict['stats_conf'][stat]['thr'][v]))
-    else:
-        thrstr = ''
+    st = stat_meta['name']
+    stnm = stat_meta['fn']
+    tstat = stat_meta['tstat']
+    thrstr = stat_meta['thr str'].get(var, '')
+
+    # Existing statistics files, listed in a single directory scan. File
+    # names are deterministic, so lists are built by membership tests.
+    st_dir = os.path.join(stat_outdir, st)
+    with os.scandir(st_dir) as it:
+        existing = {entry.name for entry in it}
+
+    def _file_list(names, reg=None):
+        rstr = '' if reg is None else '{}_'.format(reg.replace(' ', '_'))
+        fnames = ['{}_{}_{}_{}{}{}_{}{}_{}-{}_{}.nc'.format(
+            n, stnm, var, thrstr, tres[n], tstat, rstr, grdnme, yrs_d[n][0],
+            yrs_d[n][1], get_month_string(mon_d[n])) for n in names]
+        return [os.path.join(st_dir, f) for f in fnames if f in existing]
 
     # Create dictionaries with list of files for models and obs
-    _fm_list = {stat: [glob.glob(os.path.join(
-        stat_outdir, '{}'.format(st), '{}_{}_{}_{}{}{}_{}_{}-{}_{}.nc'.format(
-            m, stnm, var, thrstr, tres[m], tstat, grdnme, yrs_d[m][0],
-            yrs_d[m][1], get_month_string(mon_d[m])))) for m in models]}
-    fm_list = {s: [y for x in ll for y in x] for s, ll in _fm_list.items()}
+    fm_list = {stat: _file_list(models)}
 
     obs_list = [obs] if not isinstance(obs, list) else obs
     if obs is not None:
-        _fo_list = {stat: [glob.glob(os.path.join(
-            stat_outdir, '{}'.format(st),
-            '{}_{}_{}_{}{}{}_{}_{}-{}_{}.nc'.format(
-                o, stnm, var, thrstr, tres[o], tstat, grdnme,
-                yrs_d[o][0], yrs_d[o][1], get_month_string(mon_d[o]))))
-            for o in obs_list]}
-        fo_list = {s: [y for x in ll for y in x] for s, ll in _fo_list.items()}
+        fo_list = {stat: _file_list(obs_list)}
     else:
         fo_list = {stat: None}
 
@@ -1047,24 +1252,11 @@ def get_plot_dict(cdict, var, grid_coords, models, obs, yrs_d, mon_d, tres,
     # If there are regions, create list of files for these  as well
     # Then also update plot dictionary
     if cdict['regions'] is not None:
-        _fm_listr = {stat: {r:  [glob.glob(os.path.join(
-            stat_outdir, '{}'.format(st),
-            '{}_{}_{}_{}{}{}_{}_{}_{}-{}_{}.nc'.format(
-                m, stnm, var, thrstr, tres[m], tstat, r.replace(' ', '_'),
-                grdnme, yrs_d[m][0], yrs_d[m][1], get_month_string(mon_d[m]))))
-            for m in models] for r in cdict['regions']}}
-        fm_listr = {s: {r: [y for x in _fm_listr[s][r] for y in x]
-                        for r in _fm_listr[s]} for s in _fm_listr}
+        fm_listr = {stat: {r: _file_list(models, r)
+                           for r in cdict['regions']}}
         if obs is not None:
-            _fo_listr = {stat: {r: [glob.glob(os.path.join(
-                stat_outdir, '{}'.format(st),
-                '{}_{}_{}_{}{}{}_{}_{}_{}-{}_{}.nc'.format(
-                    o, stnm, var, thrstr, tres[o], tstat, r.replace(' ', '_'),
-                    grdnme, yrs_d[o][0], yrs_d[o][1],
-                    get_month_string(mon_d[o])))) for o in obs_list]
-                for r in cdict['regions']}}
-            fo_listr = {s: {r: [y for x in _fo_listr[s][r] for y in x]
-                            for r in _fo_listr[s]} for s in _fo_listr}
+            fo_listr = {stat: {r: _file_list(obs_list, r)
+                               for r in cdict['regions']}}
         else:
             fo_listr = {stat: None}
 
@@ -1186,7 +1378,7 @@ for var in cdict['variables']:
         # Update grid information for plotting purposes
         if mod_name not in grid_coords['meta data'][var]:
             grid_coords['meta data'][var][mod_name] = {}
-            get_grid_coords(mod_data['data'],
+            get_grid_coords(mod_data['grid'],
                             grid_coords['meta data'][var][mod_name])
 
     month_dd[var] = {m: cdict['models'][m]['months'] for m in mod_names}
@@ -1256,6 +1448,7 @@ for stat in cdict['stats_conf']:
 ###############################################
 
 print("\n=== SAVE OUTPUT ===")
+stats_meta = get_stats_meta(cdict['stats_conf'])
 tresstr = {}
 for stat in cdict['stats_conf']:
     tresstr[stat] = {}
@@ -1267,14 +1460,7 @@ for stat in cdict['stats_conf']:
         tresstr[stat][v] = timeres_def(resample_res, cdict, v,
                                        mod_names, obslist)
         # Threshold
-        thrlg = (('thr' in cdict['stats_conf'][stat]) and
-                 (cdict['stats_conf'][stat]['thr'] is not None) and
-                 (v in cdict['stats_conf'][stat]['thr']))
-        if thrlg:
-            thrval = str(cdict['stats_conf'][stat]['thr'][v])
-            thrstr = "thr{}_".format(thrval)
-        else:
-            thrstr = ''
+        thrstr = stats_meta[stat]['thr str'].get(v, '')
 
         # Grid name
         gridname = grid_coords['target grid'][v]['gridname']
@@ -1284,7 +1470,7 @@ for stat in cdict['stats_conf']:
             time_suffix = get_month_string(month_dd[v][m])
             save_to_disk(stats_dict[stat][v][m], m, stat, stat_outdir, v,
                          gridname, year_dd[v][m][0], year_dd[v][m][1],
-                         time_suffix, cdict['stats_conf'][stat],
+                         time_suffix, stats_meta[stat],
                          tresstr[stat][v][m], thrstr, cdict['regions'])
 
 
@@ -1296,13 +1482,12 @@ for stat in cdict['stats_conf']:
 
 if cdict['validation plot']:
     print('\n=== PLOTTING ===')
-    import rcat.runtime.RCAT_plots as rplot
     statnames = list(stats_dict.keys())
     for sn in statnames:
         for v in stats_dict[sn]:
             plot_dict = get_plot_dict(cdict, v, grid_coords, mod_names,
                                       cdict['variables'][v]['obs'], year_dd[v],
                                       month_dd[v], tresstr[sn][v], img_outdir,
-                                      stat_outdir, sn)
+                                      stat_outdir, sn, stats_meta[sn])
             print("\t\n** Plotting: {} for {} **".format(sn, v))
             rplot.plot_main(plot_dict, sn)
@@ -9,6 +9,8 @@ Date: Jan 2019
 """
 import numpy as np
 import logging
+import threading
+from numba import njit
 
 
 def rotated_grid_transform(lons, lats, pole_lon, pole_lat, rot2reg=True):
@@ -479,3 +481,68 @@ def add_matrix_NaNs(regridder):
     regridder.weights = sparse.coo_matrix(M)
 
     return regridder
+
+
+# Compiled sparse matrix product kernels, keyed on (nrows, ncols)
+_SPMM_KERNELS = {}
+_SPMM_LOCK = threading.Lock()
+
+
+def get_spmm_kernel(nrows, ncols):
+    """
+    Return a sparse-dense matrix product kernel Y = (A X^T)^T, with A in CSR
+    format, specialized on the shape (nrows, ncols) of A.
+
+    The shape is baked into the kernel as compile time constants: nrows
+    bounds the outer loop and ncols is checked against the input data, so
+    a mismatch between data and weights raises a ValueError inside the
+    kernel. Kernels are compiled once per shape and reused for all
+    subsequent calls. They are not cached on disk (cache=False, closures over
+    the shape cannot be), so each run recompiles the kernel once per process.
+
+    The outer loop runs over the rows of A, i.e. the target grid points, and
+    the inner loop contracts each row against all time steps in X. The kernel
+    is compiled serially (parallel=False): dask already runs blocks in
+    parallel, and the kernel is called from many worker threads of the same
+    process (LocalCluster(processes=False)). The numba workqueue threading
+    layer aborts on such concurrent calls, and omp would start a full thread
+    pool per calling thread. The GIL is released so several dask threads may
+    call the kernel concurrently. NaN/Inf-related fast math flags are left
+    out since the NaN marker from add_matrix_NaNs must propagate to the
+    output.
+
+    Parameters
+    ----------
+    nrows, ncols: int
+        Shape of the regridding weight matrix A
+
+    Returns
+    -------
+    spmm: function
+        Kernel with signature spmm(indptr, indices, vals, X, Y) where
+        indptr, indices, vals are the CSR arrays of A, X is input data with
+        shape (time, ncols) (C-contiguous) and Y the output array with shape
+        (time, nrows), filled in place. Sums are accumulated in float64
+        regardless of the dtype of X and Y.
+    """
+    key = (nrows, ncols)
+    with _SPMM_LOCK:
+        if key not in _SPMM_KERNELS:
+            @njit(parallel=False, nogil=True, cache=False,
+                  fastmath={'nsz', 'arcp', 'contract', 'reassoc'})
+            def _spmm(indptr, indices, vals, X, Y):
+                if X.shape[1] != ncols or Y.shape[1] != nrows:
+                    raise ValueError("Number of grid points in data does "
+                                     "not match the regridding weights!")
+                nt = X.shape[0]
+                for i in range(nrows):
+                    s_start = indptr[i]
+                    s_end = indptr[i+1]
+                    for t in range(nt):
+                        acc = 0.0
+                        for k in range(s_start, s_end):
+                            acc += vals[k]*X[t, indices[k]]
+                        Y[t, i] = acc
+
+            _SPMM_KERNELS[key] = _spmm
+    return _SPMM_KERNELS[key]
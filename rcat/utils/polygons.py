@@ -13,6 +13,7 @@ import os
 from mpl_toolkits.basemap import Basemap
 import matplotlib.pyplot as plt
 import argparse
+from functools import lru_cache
 
 
 def polygons(area="", poly_print=False):
@@ -114,17 +115,10 @@ def mask_region(xp, yp, area, data=None, iter_3d=None, cut_data=False):
         nx = xp.size
         ny = yp.size
 
-    # Rearrange grid points into a list of tuples
-    points = [(xp[i, j], yp[i, j]) if xp.ndim == 2 else (xp[j], yp[i]) for i in
-              range(ny) for j in range(nx)]
+    # Rearrange grid points into an array of (x, y) pairs
+    points = _grid_points(xp, yp)
     if type(area).__name__ == 'str':
-        def coord_return(line):
-            s = line.split()
-            return list(map(float, s))
-        reg_file = polygons(area)
-        with open(reg_file, 'r') as ff:
-            ff.readline()       # Skip first line
-            poly = [coord_return(ln) for ln in ff.readlines()]
+        poly = _region_polygon(area)
     else:
         poly = area
     reg_path = Path(np.array(poly))
@@ -176,6 +170,70 @@ def mask_region(xp, yp, area, data=None, iter_3d=None, cut_data=False):
     return masked_out
 
 
+def mask_regions(xp, yp, areas):
+    """
+    Create 2D masks for several regions on the same grid.
+
+    Grid points are arranged only once and shared between the regions.
+
+    Parameters
+    ----------
+    xp,yp: numpy arrays
+        eastward and northward grid points respectively, normally lon/lat
+        arrays.
+    areas: list
+        List of regions; each item either a name of a predefined region or a
+        list with tuples defining a polygon (see mask_region).
+
+    Returns
+    -------
+    masks: dict
+        Dictionary with a 2D boolean mask for each region in areas, True
+        inside region of interest, False outside. Keys are region names for
+        predefined regions and the list index for polygon inputs.
+    """
+
+    from matplotlib.path import Path
+
+    ny, nx = xp.shape if xp.ndim == 2 else (yp.size, xp.size)
+    points = _grid_points(xp, yp)
+    masks = {}
+    for i, area in enumerate(areas):
+        if isinstance(area, str):
+            key, poly = area, _region_polygon(area)
+        else:
+            key, poly = i, area
+        masks[key] = Path(np.array(poly)).contains_points(
+            points).reshape(ny, nx)
+    return masks
+
+
+def _grid_points(xp, yp):
+    """
+    Return grid points as an array of shape (ny*nx, 2) with (x, y) pairs.
+    """
+    if xp.ndim == 2:
+        return np.column_stack([xp.ravel(), yp.ravel()])
+    else:
+        xx, yy = np.meshgrid(xp, yp)
+        return np.column_stack([xx.ravel(), yy.ravel()])
+
+
+@lru_cache(maxsize=None)
+def _region_polygon(area):
+    """
+    Read polygon of predefined region 'area' from file (cached).
+    """
+    def coord_return(line):
+        s = line.split()
+        return list(map(float, s))
+    reg_file = polygons(area)
+    with open(reg_file, 'r') as ff:
+        ff.readline()       # Skip first line
+        poly = np.array([coord_return(ln) for ln in ff.readlines()])
+    return poly
+
+
 def create_polygon():
     """
     Retrieve polygon arbitrarily drawn interactively on a map
@@ -25,5 +25,6 @@ setuptools.setup(
     ],
     python_requires='>=3.0',
     install_requires=['numpy', 'xarray', 'esmpy', 'xesmf', 'dask[complete]', 
-                      'netcdf4', 'dask-jobqueue'],
+                      'netcdf4', 'h5netcdf', 'h5py', 'dask-jobqueue',
+                      'numba'],
 )